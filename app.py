@@ -1,8 +1,20 @@
+import functools
+import itertools
+import json
 import os
+import queue
+import re
+import shutil
 import sqlite3
+import tempfile
+from pathlib import Path
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
 from datetime import datetime, timedelta, date
-from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, jsonify
-from werkzeug.utils import secure_filename
+from flask import Flask, Request, Response, render_template, request, redirect, url_for, flash, send_from_directory, jsonify, g, abort
+from werkzeug.utils import safe_join, secure_filename, send_file
 from sqlite3 import IntegrityError
 
 # ---- Optional: load .env ----
@@ -15,79 +27,304 @@ except Exception:
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 DEFAULT_DB = os.path.join(BASE_DIR, "absher.db")
 DEFAULT_UPLOADS = os.path.join(BASE_DIR, "uploads")
+REQUESTS_PER_PAGE = 50
+_MAX_PAGE = (2**63 - 1) // REQUESTS_PER_PAGE
 ALLOWED_EXTENSIONS = {"pdf", "png", "jpg", "jpeg", "doc", "docx", "xlsx", "xls", "zip"}
+_ALLOWED_FROZEN = frozenset(ALLOWED_EXTENSIONS)
+
+class UploadRequest(Request):
+    """يكتب المحلل كل مرفق مباشرة إلى ملف مؤقت داخل مجلد المرفقات، فيُنقل لاحقًا بإعادة تسمية بدل نسخه."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        tmp = tempfile.NamedTemporaryFile(dir=app.config["UPLOAD_FOLDER"], prefix=".upload-", delete=False)
+        self.__dict__.setdefault("upload_tmp_files", []).append(tmp)
+        return tmp
 
 app = Flask(__name__)
+app.request_class = UploadRequest
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret-change-me")
 app.config["UPLOAD_FOLDER"] = os.environ.get("UPLOAD_FOLDER", DEFAULT_UPLOADS)
-os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024
+# خلف Apache/lighttpd مع mod_xsendfile: الخادم يرسل الملف مباشرة من القرص بدل مروره عبر Python
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "") == "1"
+# خلف nginx: بادئة موقع internal يشير إلى مجلد المرفقات (مثل /protected_uploads)
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+@functools.lru_cache(maxsize=32)
+def _ensure_dir(p: str):
+    """ينشئ المجلد مرة واحدة لكل مسار في العملية بدل makedirs (stat) مع كل استدعاء."""
+    os.makedirs(p, exist_ok=True)
+
+_ensure_dir(app.config["UPLOAD_FOLDER"])
+
+# ---- Optional: ضغط الردود النصية (gzip/brotli) ----
+# text/event-stream غير مدرج عمدًا حتى لا يُخزَّن بث المحادثة مؤقتًا قبل ضغطه
+app.config["COMPRESS_MIMETYPES"] = ["text/html", "application/json", "text/css", "application/javascript", "text/javascript"]
+app.config["COMPRESS_LEVEL"] = 6
+app.config["COMPRESS_MIN_SIZE"] = 512
+try:
+    from flask_compress import Compress
+    Compress(app)
+except Exception:
+    pass
+
+# ===================== SQL =====================
+# نصوص ثابتة يعاد استخدامها حرفيًا، فيلتقطها statement cache الخاص بـ sqlite3 بدل إعادة الترجمة
+_SQL = {
+    "settings_row": "SELECT * FROM settings WHERE id=1",
+    "settings_upsert": """INSERT INTO settings (id, company_name, company_db_path, upload_folder)
+                          VALUES (1, ?, ?, ?)
+                          ON CONFLICT(id) DO UPDATE SET
+                            company_name=excluded.company_name,
+                            company_db_path=excluded.company_db_path,
+                            upload_folder=excluded.upload_folder""",
+    # التجميع داخل SQLite؛ الترتيب بآخر نشاط يحافظ على ترتيب الفئات كما كان يُبنى في Python
+    "dashboard_status": """SELECT COALESCE(NULLIF(TRIM(status), ''), 'Submitted') AS k, COUNT(*) AS n
+                           FROM requests GROUP BY k""",
+    "dashboard_category": """SELECT COALESCE(NULLIF(TRIM(category), ''), 'Other') AS k, COUNT(*) AS n
+                             FROM requests GROUP BY k
+                             ORDER BY MAX(COALESCE(updated_at, created_at)) DESC""",
+    "dashboard_team": """SELECT COALESCE(NULLIF(TRIM(assignee), ''), 'Unassigned') AS k, COUNT(*) AS n
+                         FROM requests GROUP BY k
+                         ORDER BY MAX(COALESCE(updated_at, created_at)) DESC""",
+    "dashboard_timeline": """SELECT substr(created_at, 1, 10) AS d, COUNT(*) AS n
+                             FROM requests WHERE created_at >= ? GROUP BY d""",
+    "dashboard_recent": ("SELECT request_no, employee_name, category, status, created_at, updated_at "
+                         "FROM requests ORDER BY COALESCE(updated_at, created_at) DESC LIMIT 10"),
+    "list_requests": """SELECT id, request_no, employee_name, category, request_type, status,
+                              assignee, duration_days, created_at
+                       FROM requests ORDER BY created_at DESC LIMIT ? OFFSET ?""",
+    "view_request_req": "SELECT * FROM requests WHERE request_no=?",
+    "view_request_atts": """SELECT a.* FROM attachments a
+                            JOIN requests r ON a.request_id = r.id
+                            WHERE r.request_no = ?""",
+    "insert_request": """INSERT INTO requests
+                         (request_no, employee_id, employee_name, cluster, department,
+                          category, request_type, details, status, assignee, duration_days, created_at, updated_at)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+    "max_request_no": "SELECT MAX(CAST(request_no AS INTEGER)) FROM requests WHERE request_no GLOB '[0-9]*'",
+    "numeric_request_nos": "SELECT request_no FROM requests WHERE request_no GLOB '[0-9]*'",
+    "request_no_taken": "SELECT request_no FROM requests WHERE request_no = ? OR request_no GLOB ?",
+    "update_status": "UPDATE requests SET status=?, assignee=?, updated_at=? WHERE request_no=?",
+    "chat_request": ("SELECT employee_id, employee_name, department, category, request_type, status, "
+                     "assignee, duration_days, created_at, details FROM requests WHERE request_no=?"),
+}
+
+# تُطبّق مرة واحدة عند فتح كل اتصال: WAL حتى لا تحجب الكتابة القراءة، وكاش صفحات أكبر، وmmap للقراءة
+_WRITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+)
+_PRAGMAS = (
+    "busy_timeout=5000",
+    "temp_store=MEMORY",
+    "cache_size=-65536",
+    "mmap_size=268435456",
+)
+
+# ===================== Connection pool =====================
+# اتصالات طويلة العمر لكل (قاعدة، وضع) على مستوى العملية، فيبقى كاش صفحات SQLite دافئًا بين الطلبات
+POOL_SIZE = 8  # أقصى عدد اتصالات خاملة محفوظة لكل قاعدة
+_POOL: dict = {}
+_POOL_LOCK = threading.Lock()
+
+def _new_con(db_path: str, readonly: bool) -> sqlite3.Connection:
+    if readonly:
+        uri = Path(db_path).resolve().as_uri() + "?mode=ro"
+        con = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None)
+        pragmas = _PRAGMAS
+    else:
+        con = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        pragmas = _WRITE_PRAGMAS + _PRAGMAS
+    con.row_factory = sqlite3.Row
+    for p in pragmas:
+        con.execute(f"PRAGMA {p}")
+    return con
+
+def _acquire(db_path: str, readonly: bool) -> sqlite3.Connection:
+    with _POOL_LOCK:
+        q = _POOL.setdefault((db_path, readonly), queue.Queue(maxsize=POOL_SIZE))
+    try:
+        return q.get_nowait()
+    except queue.Empty:
+        return _new_con(db_path, readonly)
+
+def _release(db_path: str, readonly: bool, con: sqlite3.Connection):
+    if con.in_transaction:
+        con.rollback()
+    try:
+        _POOL[(db_path, readonly)].put_nowait(con)
+    except queue.Full:
+        con.close()
+
+def _close_pool():
+    with _POOL_LOCK:
+        pools = list(_POOL.values())
+        _POOL.clear()
+    for q in pools:
+        while not q.empty():
+            q.get_nowait().close()
+
+@contextmanager
+def get_conn(db_path: str, readonly: bool = False):
+    """يستعير اتصالًا من المجمّع ويعيده عند الخروج من الكتلة."""
+    con = _acquire(db_path, readonly)
+    try:
+        yield con
+    finally:
+        _release(db_path, readonly, con)
 
 # ===================== Helpers & Bootstrapping =====================
+def get_con(db_path: str = None, readonly: bool = False) -> sqlite3.Connection:
+    """اتصال واحد لكل قاعدة طوال سياق التطبيق، مستعار من المجمّع ويعاد إليه عند انتهاء السياق.
+
+    readonly=True يفتح القاعدة بـ mode=ro لمسارات العرض فقط، فلا تنافس على قفل الكتابة.
+    """
+    db_path = db_path or get_db_path()
+    cons = g.setdefault("_db_cons", {})
+    con = cons.get((db_path, readonly))
+    if con is None:
+        con = cons[(db_path, readonly)] = _acquire(db_path, readonly)
+    return con
+
+@app.teardown_appcontext
+def _release_cons(exc):
+    for (db_path, readonly), con in g.pop("_db_cons", {}).items():
+        _release(db_path, readonly, con)
+
+# umask لا يُقرأ إلا بتعيينه؛ نقرؤه مرة عند الاستيراد قبل بدء الخيوط ثم نعيده كما كان
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+def _store_upload(f, savepath: str):
+    # الملف المؤقت في نفس المجلد غالبًا، فتكون النقلة إعادة تسمية فقط؛ shutil.move ينسخ لو تغيّر القرص
+    stream = f.stream
+    if isinstance(getattr(stream, "name", None), str):
+        stream.close()
+        shutil.move(stream.name, savepath)
+        # NamedTemporaryFile ينشئ بصلاحية 0600؛ نطبّق umask مثل f.save ليقرأ nginx/Apache الملف
+        os.chmod(savepath, 0o666 & ~_UMASK)
+    else:
+        f.save(savepath)
+
+@app.teardown_request
+def _cleanup_upload_tmp_files(exc):
+    # مرفقات لم تُحفظ (امتداد غير مسموح أو خطأ) تُحذف ملفاتها المؤقتة
+    for tmp in request.__dict__.get("upload_tmp_files", ()):
+        tmp.close()
+        try:
+            os.remove(tmp.name)
+        except FileNotFoundError:
+            pass
+
+@contextmanager
+def write_txn(con):
+    """معاملة كتابة تحجز قفل الكتابة من بدايتها، فلا تفشل بـ SQLITE_BUSY في منتصفها مع تعدد الخيوط."""
+    con.execute("BEGIN IMMEDIATE")
+    with con:
+        yield con
+
+def utcnow_iso() -> str:
+    """طابع UTC بدقة الثانية: 19 حرفًا بدل 26، ويبقى قابلًا للترتيب نصيًا ومتوافقًا مع القيم القديمة."""
+    return datetime.utcnow().isoformat(timespec="seconds")
+
+# أسماء المرفقات تتكرر كثيرًا (report.pdf, id.jpg) فنخزن ناتج التنظيف بدل إعادة تعابير regex
+_secure = functools.lru_cache(maxsize=1024)(secure_filename)
+
 def allowed_file(filename: str) -> bool:
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, ext = filename.rpartition(".")
+    return bool(dot) and ext.lower() in _ALLOWED_FROZEN
 
 def _bootstrap_default_settings_table():
-    with sqlite3.connect(DEFAULT_DB) as con:
-        cur = con.cursor()
-        cur.execute("""CREATE TABLE IF NOT EXISTS settings(id INTEGER PRIMARY KEY)""")
-        cur.execute("PRAGMA table_info(settings)")
-        cols = {row[1] for row in cur.fetchall()}
-        if "company_name" not in cols:   cur.execute("ALTER TABLE settings ADD COLUMN company_name TEXT")
-        if "company_db_path" not in cols:cur.execute("ALTER TABLE settings ADD COLUMN company_db_path TEXT")
-        if "upload_folder" not in cols:  cur.execute("ALTER TABLE settings ADD COLUMN upload_folder TEXT")
-        cur.execute("SELECT id FROM settings WHERE id=1")
-        if not cur.fetchone():
-            cur.execute("INSERT INTO settings (id, company_name, company_db_path, upload_folder) VALUES (1, ?, ?, ?)",
-                        ("My Company", "", app.config["UPLOAD_FOLDER"]))
-        else:
-            cur.execute("""UPDATE settings
-                           SET company_name=COALESCE(company_name,'My Company'),
-                               company_db_path=COALESCE(company_db_path,''),
-                               upload_folder=COALESCE(upload_folder,?)
-                           WHERE id=1""", (app.config["UPLOAD_FOLDER"],))
-        con.commit()
+    con = get_con(DEFAULT_DB)
+    cur = con.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS settings(id INTEGER PRIMARY KEY)""")
+    cur.execute("PRAGMA table_info(settings)")
+    cols = {row[1] for row in cur.fetchall()}
+    if "company_name" not in cols:   cur.execute("ALTER TABLE settings ADD COLUMN company_name TEXT")
+    if "company_db_path" not in cols:cur.execute("ALTER TABLE settings ADD COLUMN company_db_path TEXT")
+    if "upload_folder" not in cols:  cur.execute("ALTER TABLE settings ADD COLUMN upload_folder TEXT")
+    cur.execute("SELECT id FROM settings WHERE id=1")
+    if not cur.fetchone():
+        cur.execute("INSERT INTO settings (id, company_name, company_db_path, upload_folder) VALUES (1, ?, ?, ?)",
+                    ("My Company", "", app.config["UPLOAD_FOLDER"]))
+    else:
+        cur.execute("""UPDATE settings
+                       SET company_name=COALESCE(company_name,'My Company'),
+                           company_db_path=COALESCE(company_db_path,''),
+                           upload_folder=COALESCE(upload_folder,?)
+                       WHERE id=1""", (app.config["UPLOAD_FOLDER"],))
+
+# صف الإعدادات (id=1) محفوظ في الذاكرة ويُحدَّث مباشرة عند الحفظ من صفحة الإعدادات.
+# يعاد تحميله كل SETTINGS_TTL ثانية فقط حتى تلتقط عمّال Gunicorn الأخرى التغيير.
+SETTINGS_TTL = 5
+_SETTINGS = {"row": {}, "db_path": DEFAULT_DB, "loaded_at": None}
+_SETTINGS_LOCK = threading.Lock()
+
+def _set_settings(row: dict):
+    global _SETTINGS
+    path = row.get("company_db_path") or ""
+    # استبدال القاموس كاملًا حتى لا يرى خيط آخر نسخة نصف محدّثة
+    _SETTINGS = {"row": row, "db_path": path or DEFAULT_DB, "loaded_at": time.monotonic()}
+
+def get_settings() -> dict:
+    if _settings_stale():
+        with _SETTINGS_LOCK:
+            # الخيوط التي انتظرت القفل تجد النسخة محدّثة فلا تكرر الاستعلام
+            if _settings_stale():
+                row = get_con(DEFAULT_DB, readonly=True).execute(_SQL["settings_row"]).fetchone()
+                _set_settings(dict(row) if row else {})
+    return _SETTINGS["row"]
+
+def _settings_stale() -> bool:
+    loaded_at = _SETTINGS["loaded_at"]
+    return loaded_at is None or time.monotonic() - loaded_at > SETTINGS_TTL
 
 def get_db_path() -> str:
-    _bootstrap_default_settings_table()
-    with sqlite3.connect(DEFAULT_DB) as con:
-        con.row_factory = sqlite3.Row
-        row = con.execute("SELECT company_db_path FROM settings WHERE id=1").fetchone()
-        if row and row["company_db_path"]:
-            path = row["company_db_path"]
-            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-            return path
-    return DEFAULT_DB
+    get_settings()
+    return _SETTINGS["db_path"]
 
 def init_schema(db_path: str):
-    with sqlite3.connect(db_path) as con:
-        con.execute(
-            """CREATE TABLE IF NOT EXISTS requests(
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 request_no TEXT UNIQUE,
-                 employee_id TEXT,
-                 employee_name TEXT,
-                 cluster TEXT,
-                 department TEXT,
-                 category TEXT,
-                 request_type TEXT,
-                 details TEXT,
-                 status TEXT,
-                 assignee TEXT,
-                 duration_days INTEGER,
-                 created_at TEXT,
-                 updated_at TEXT
-            )"""
-        )
-        con.execute(
-            """CREATE TABLE IF NOT EXISTS attachments(
-                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                 request_id INTEGER,
-                 filename TEXT,
-                 path TEXT,
-                 uploaded_at TEXT,
-                 FOREIGN KEY(request_id) REFERENCES requests(id)
-            )"""
-        )
+    con = get_con(db_path)
+    con.execute(
+        """CREATE TABLE IF NOT EXISTS requests(
+             id INTEGER PRIMARY KEY AUTOINCREMENT,
+             request_no TEXT UNIQUE,
+             employee_id TEXT,
+             employee_name TEXT,
+             cluster TEXT,
+             department TEXT,
+             category TEXT,
+             request_type TEXT,
+             details TEXT,
+             status TEXT,
+             assignee TEXT,
+             duration_days INTEGER,
+             created_at TEXT,
+             updated_at TEXT
+        )"""
+    )
+    con.execute(
+        """CREATE TABLE IF NOT EXISTS attachments(
+             id INTEGER PRIMARY KEY AUTOINCREMENT,
+             request_id INTEGER,
+             filename TEXT,
+             path TEXT,
+             uploaded_at TEXT,
+             FOREIGN KEY(request_id) REFERENCES requests(id)
+        )"""
+    )
+
+def init_indexes(db_path: str):
+    """الفهارس بعد ensure_schema_compat: القواعد القديمة قد تنقصها الأعمدة المفهرسة حتى تُرقّى."""
+    con = get_con(db_path)
+    try:
+        con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_requests_request_no ON requests(request_no)")
+    except IntegrityError:
+        # قواعد قديمة قد تحتوي أرقامًا مكررة؛ نكتفي بفهرس عادي للبحث
+        con.execute("CREATE INDEX IF NOT EXISTS idx_requests_request_no_nonunique ON requests(request_no)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_attachments_request_id ON attachments(request_id)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_requests_created_at ON requests(created_at DESC)")
+    # نفس التعبير المستخدم في ترتيب لوحة التحكم، فيمشي SQLite على الفهرس بدل الفرز
+    con.execute("CREATE INDEX IF NOT EXISTS idx_requests_activity ON requests(COALESCE(updated_at, created_at) DESC)")
 
 def _ensure_column(con, table, col, ddl_type):
     cur = con.cursor()
@@ -98,74 +335,92 @@ def _ensure_column(con, table, col, ddl_type):
 
 def ensure_schema_compat(db_path: str):
     """ترقيات آمنة لأي قاعدة قديمة (بدون فقد بيانات)."""
-    with sqlite3.connect(db_path) as con:
-        for name, t in [
-            ("request_no","TEXT"),("employee_id","TEXT"),("employee_name","TEXT"),
-            ("cluster","TEXT"),("department","TEXT"),("category","TEXT"),
-            ("request_type","TEXT"),("details","TEXT"),("status","TEXT"),
-            ("assignee","TEXT"),("duration_days","INTEGER"),
-            ("created_at","TEXT"),("updated_at","TEXT")
-        ]:
-            _ensure_column(con, "requests", name, t)
-
-        cur = con.cursor()
-        cur.execute("PRAGMA table_info(attachments)")
-        rows = cur.fetchall()
-        acols = {r[1] for r in rows}
-        if "path" not in acols and "filepath" not in acols:
-            cur.execute("ALTER TABLE attachments ADD COLUMN path TEXT")
-        if "filename" not in acols:
-            cur.execute("ALTER TABLE attachments ADD COLUMN filename TEXT")
-        if "request_id" not in acols:
-            cur.execute("ALTER TABLE attachments ADD COLUMN request_id INTEGER")
-        if "uploaded_at" not in acols:
-            cur.execute("ALTER TABLE attachments ADD COLUMN uploaded_at TEXT")
-
-        # املأ filepath من path لو كان NOT NULL
-        notnull_map = {r[1]: bool(r[3]) for r in rows}
-        if "filepath" in acols and notnull_map.get("filepath", False):
-            cur.execute("UPDATE attachments SET filepath = COALESCE(filepath, path) WHERE filepath IS NULL AND path IS NOT NULL")
-
-        con.commit()
+    con = get_con(db_path)
+    for name, t in [
+        ("request_no","TEXT"),("employee_id","TEXT"),("employee_name","TEXT"),
+        ("cluster","TEXT"),("department","TEXT"),("category","TEXT"),
+        ("request_type","TEXT"),("details","TEXT"),("status","TEXT"),
+        ("assignee","TEXT"),("duration_days","INTEGER"),
+        ("created_at","TEXT"),("updated_at","TEXT")
+    ]:
+        _ensure_column(con, "requests", name, t)
+
+    cur = con.cursor()
+    cur.execute("PRAGMA table_info(attachments)")
+    rows = cur.fetchall()
+    acols = {r[1] for r in rows}
+    if "path" not in acols and "filepath" not in acols:
+        cur.execute("ALTER TABLE attachments ADD COLUMN path TEXT")
+    if "filename" not in acols:
+        cur.execute("ALTER TABLE attachments ADD COLUMN filename TEXT")
+    if "request_id" not in acols:
+        cur.execute("ALTER TABLE attachments ADD COLUMN request_id INTEGER")
+    if "uploaded_at" not in acols:
+        cur.execute("ALTER TABLE attachments ADD COLUMN uploaded_at TEXT")
+
+    # املأ filepath من path لو كان NOT NULL
+    notnull_map = {r[1]: bool(r[3]) for r in rows}
+    if "filepath" in acols and notnull_map.get("filepath", False):
+        cur.execute("UPDATE attachments SET filepath = COALESCE(filepath, path) WHERE filepath IS NULL AND path IS NOT NULL")
 
 def discover_attachment_cols(db_path: str):
-    with sqlite3.connect(db_path) as con:
-        cur = con.cursor()
-        cur.execute("PRAGMA table_info(attachments)")
-        rows = cur.fetchall()
+    rows = get_con(db_path).execute("PRAGMA table_info(attachments)").fetchall()
     cols = {r[1] for r in rows}
     notnull = {r[1]: bool(r[3]) for r in rows}
+    # جملة الإدراج تُبنى هنا مرة واحدة حسب أعمدة المسار الموجودة (path و/أو filepath)
+    path_cols = [c for c in ("path", "filepath") if c in cols] or ["path"]
     return {
         "has_path": "path" in cols,
         "has_filepath": "filepath" in cols,
-        "filepath_notnull": notnull.get("filepath", False)
+        "filepath_notnull": notnull.get("filepath", False),
+        "path_cols": tuple(path_cols),
+        "path_slots": len(path_cols),
+        "insert_sql": (f"INSERT INTO attachments (request_id, filename, {', '.join(path_cols)}, uploaded_at) "
+                       f"VALUES (?, ?, {', '.join('?' * len(path_cols))}, ?)"),
     }
 
+# أعمدة المرفقات لكل قاعدة جُهّزت في هذه العملية؛ المخطط لا يتغير أثناء عمل العملية
+_ATTACHMENT_COLS: dict = {}
+_PREPARE_LOCK = threading.Lock()
+
+def prepare_db(db_path: str) -> dict:
+    """ينشئ المخطط ويرقّيه ويكتشف أعمدة المرفقات مرة واحدة لكل قاعدة، ثم يعيد النتيجة المحفوظة."""
+    cols = _ATTACHMENT_COLS.get(db_path)
+    if cols is None:
+        with _PREPARE_LOCK:
+            cols = _ATTACHMENT_COLS.get(db_path)
+            if cols is None:
+                init_schema(db_path)
+                ensure_schema_compat(db_path)
+                init_indexes(db_path)
+                cols = _ATTACHMENT_COLS[db_path] = discover_attachment_cols(db_path)
+    return cols
+
+# أرقام ASCII فقط: str.isdigit يقبل "²" و"٣" فيفشل int() أو يخلط الترقيم
+_DIGITS = re.compile(r"[0-9]+")
+_INT64_MAX = 2**63 - 1
+
+def _glob_escape(s: str) -> str:
+    # GLOB بلا محرف هروب؛ نضع المحارف الخاصة بين أقواس لتُطابَق حرفيًا
+    return "".join(f"[{ch}]" if ch in "[*?" else ch for ch in s)
+
 def generate_unique_request_no(con, desired: str) -> str:
-    cur = con.cursor()
     if not desired:
-        cur.execute("SELECT request_no FROM requests")
-        nums = []
-        for (rn,) in cur.fetchall():
-            if rn is None: continue
-            s = str(rn)
-            num = ""
-            for ch in s:
-                if ch.isdigit(): num += ch
-                else: break
-            if num: nums.append(int(num))
-        next_no = (max(nums) + 1) if nums else 1
-        return str(next_no)
-    cur.execute("SELECT 1 FROM requests WHERE request_no=?", (desired,))
-    if not cur.fetchone():
+        # CAST يأخذ البادئة الرقمية فقط ('12-1' → 12)، فيطابق منطق "أكبر رقم + 1" السابق
+        top = con.execute(_SQL["max_request_no"]).fetchone()[0]
+        if top is None:
+            return "1"
+        if not isinstance(top, int) or top >= _INT64_MAX:
+            # رقم من 19 خانة فأكثر يقصّه CAST إلى حد INTEGER؛ نحسب الأكبر بأعداد Python كما كان سابقًا
+            top = max(int(_DIGITS.match(str(rn)).group()) for (rn,) in con.execute(_SQL["numeric_request_nos"]))
+        # الجمع في Python: "+ 1" في SQL بعد الحد الأقصى ينتج REAL مثل 9.223372036854776e+18
+        return str(top + 1)
+    prefix = f"{desired}-"
+    taken = [str(rn) for (rn,) in con.execute(_SQL["request_no_taken"], (desired, _glob_escape(prefix) + "*"))]
+    if desired not in taken:
         return desired
-    i = 1
-    while True:
-        candidate = f"{desired}-{i}"
-        cur.execute("SELECT 1 FROM requests WHERE request_no=?", (candidate,))
-        if not cur.fetchone():
-            return candidate
-        i += 1
+    suffixes = [int(m.group()) for rn in taken if (m := _DIGITS.fullmatch(rn, len(prefix)))]
+    return f"{desired}-{max(suffixes, default=0) + 1}"
 
 def migrate_old_requests_if_empty(active_db: str):
     """
@@ -177,9 +432,8 @@ def migrate_old_requests_if_empty(active_db: str):
 
     def count(db):
         try:
-            with sqlite3.connect(db) as con:
-                cur = con.execute("SELECT COUNT(*) FROM requests")
-                return cur.fetchone()[0]
+            with get_conn(db) as con:
+                return con.execute("SELECT COUNT(*) FROM requests").fetchone()[0]
         except sqlite3.Error:
             return 0
 
@@ -188,45 +442,50 @@ def migrate_old_requests_if_empty(active_db: str):
     if new_count > 0 or old_count == 0:
         return
 
-    init_schema(active_db); ensure_schema_compat(active_db)
-    init_schema(old_db);    ensure_schema_compat(old_db)
-
-    with sqlite3.connect(old_db) as src, sqlite3.connect(active_db) as dst:
-        src.row_factory = sqlite3.Row
-        rows = src.execute("SELECT * FROM requests").fetchall()
-        for r in rows:
-            dst.execute(
-                """INSERT OR IGNORE INTO requests
-                   (request_no, employee_id, employee_name, cluster, department, category, request_type,
-                    details, status, assignee, duration_days, created_at, updated_at)
-                   VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                (
-                    r["request_no"], r["employee_id"], r["employee_name"], r["cluster"], r["department"],
-                    r["category"], r["request_type"], r["details"], r["status"], r["assignee"],
-                    r["duration_days"], r["created_at"], r["updated_at"]
+    src_path_col = "filepath" if prepare_db(old_db)["has_filepath"] else "path"
+    dst_path_cols = prepare_db(active_db)["path_cols"]
+
+    # ATTACH ثم INSERT ... SELECT: النسخ كله داخل SQLite بلا صفوف Python
+    # id الطلبات يُنقل كما هو (القاعدة الجديدة فارغة) فيبقى request_id في المرفقات يشير للطلب الصحيح
+    with get_conn(active_db) as dst:
+        dst.execute("ATTACH DATABASE ? AS old", (old_db,))
+        try:
+            with write_txn(dst):
+                dst.execute(
+                    """INSERT OR IGNORE INTO requests
+                       (id, request_no, employee_id, employee_name, cluster, department, category, request_type,
+                        details, status, assignee, duration_days, created_at, updated_at)
+                       SELECT id, request_no, employee_id, employee_name, cluster, department, category, request_type,
+                              details, status, assignee, duration_days, created_at, updated_at
+                       FROM old.requests"""
                 )
-            )
-        def att_col(db):
-            with sqlite3.connect(db) as con2:
-                cur = con2.execute("PRAGMA table_info(attachments)")
-                cols = {row[1] for row in cur.fetchall()}
-                return "filepath" if "filepath" in cols else "path"
-        src_path_col = att_col(old_db)
-        dst_path_col = att_col(active_db)
-
-        atts = src.execute("SELECT * FROM attachments").fetchall()
-        for a in atts:
-            dst.execute(
-                f"INSERT OR IGNORE INTO attachments (request_id, filename, {dst_path_col}, uploaded_at) VALUES (?,?,?,?)",
-                (a["request_id"], a["filename"], a[src_path_col], a["uploaded_at"])
-            )
-        dst.commit()
+                dst.execute(
+                    f"INSERT INTO attachments (request_id, filename, {', '.join(dst_path_cols)}, uploaded_at) "
+                    f"SELECT request_id, filename, {', '.join([src_path_col] * len(dst_path_cols))}, uploaded_at "
+                    f"FROM old.attachments"
+                )
+        finally:
+            # الاتصال يعود للمجمع فلا نتركه مرتبطًا بالقاعدة القديمة
+            dst.execute("DETACH DATABASE old")
 
 # bootstrap
-db_path_boot = get_db_path()
-init_schema(db_path_boot)
-ensure_schema_compat(db_path_boot)
-migrate_old_requests_if_empty(db_path_boot)
+_STARTUP_DONE = threading.Event()
+
+def _startup_once():
+    """تهيئة الإعدادات والمخطط والترحيل مرة واحدة للعملية بدل تكرارها في كل طلب."""
+    if _STARTUP_DONE.is_set():
+        return
+    with app.app_context():
+        _bootstrap_default_settings_table()
+        db_path = get_db_path()
+        _ensure_dir(os.path.dirname(db_path) or ".")
+        prepare_db(db_path)
+        migrate_old_requests_if_empty(db_path)
+    # لا نورّث اتصالات SQLite عبر fork (preload_app في Gunicorn)؛ كل عامل يفتح اتصالاته بنفسه
+    _close_pool()
+    _STARTUP_DONE.set()
+
+_startup_once()
 
 # ===================== Routes =====================
 @app.route("/")
@@ -238,33 +497,36 @@ def index():
 def _home_alias():
     return index()
 
+# نتائج لوحة التحكم محفوظة حتى يتغير جدول requests في هذه العملية أو تمر DASHBOARD_TTL ثانية
+# (المهلة تغطي الكتابات من عمّال Gunicorn الآخرين)
+DASHBOARD_TTL = 5
+_REQUESTS_VERSION = itertools.count(1)
+_requests_version = 0
+_DASH_CACHE = {"key": None, "payload": None, "exp": 0.0}
+_DASH_LOCK = threading.Lock()
+
+def _bump_requests_version():
+    global _requests_version
+    _requests_version = next(_REQUESTS_VERSION)
+
 @app.route("/dashboard")
 def dashboard():
     db_path = get_db_path()
-    ensure_schema_compat(db_path)
-    with sqlite3.connect(db_path) as con:
-        con.row_factory = sqlite3.Row
-        rows = con.execute("SELECT * FROM requests ORDER BY datetime(COALESCE(updated_at, created_at)) DESC").fetchall()
-
-    def g(r, k, default=None):
-        try: return r[k]
-        except Exception: return default
-
-    total = len(rows)
-    status_counts = {"Submitted":0, "In Progress":0, "Completed":0, "Rejected":0}
-    cat_counts, team_counts = {}, {}
+    key = (db_path, _requests_version)
+    with _DASH_LOCK:
+        if _DASH_CACHE["key"] == key and time.monotonic() < _DASH_CACHE["exp"]:
+            stats, recent_requests = _DASH_CACHE["payload"]
+            return render_template("dashboard.html", stats=stats, recent_requests=recent_requests)
+
+    con = get_con(db_path, readonly=True)
     last7 = [(date.today()-timedelta(days=i)).strftime("%Y-%m-%d") for i in range(6,-1,-1)]
-    timeline_counts = {d:0 for d in last7}
-
-    for r in rows:
-        st = (g(r,"status") or "Submitted").strip()
-        status_counts[st] = status_counts.get(st,0)+1
-        cat = (g(r,"category") or "Other").strip() or "Other"
-        cat_counts[cat] = cat_counts.get(cat,0)+1
-        team = (g(r,"assignee") or "Unassigned").strip() or "Unassigned"
-        team_counts[team] = team_counts.get(team,0)+1
-        created = (g(r,"created_at") or "")[:10]
-        if created in timeline_counts: timeline_counts[created]+=1
+
+    status_counts = dict(con.execute(_SQL["dashboard_status"]).fetchall())
+    cat_counts = dict(con.execute(_SQL["dashboard_category"]).fetchall())
+    team_counts = dict(con.execute(_SQL["dashboard_team"]).fetchall())
+    timeline_counts = dict(con.execute(_SQL["dashboard_timeline"], (last7[0],)).fetchall())
+    recent_requests = con.execute(_SQL["dashboard_recent"]).fetchall()
+    total = sum(status_counts.values())
 
     stats = {
         "total": total,
@@ -276,9 +538,10 @@ def dashboard():
         "category_values": list(cat_counts.values()),
         "by_team": team_counts,
         "timeline_labels": last7,
-        "timeline_values": [timeline_counts[d] for d in last7],
+        "timeline_values": [timeline_counts.get(d, 0) for d in last7],
     }
-    recent_requests = rows[:10]
+    with _DASH_LOCK:
+        _DASH_CACHE.update(key=key, payload=(stats, recent_requests), exp=time.monotonic() + DASHBOARD_TTL)
     return render_template("dashboard.html", stats=stats, recent_requests=recent_requests)
 
 @app.route("/settings", methods=["GET", "POST"])
@@ -288,26 +551,28 @@ def settings():
         company_db_path = request.form.get("company_db_path", "").strip()
         upload_folder = request.form.get("upload_folder", "").strip()
         if upload_folder:
-            os.makedirs(upload_folder, exist_ok=True)
+            _ensure_dir(upload_folder)
+        if company_db_path:
+            _ensure_dir(os.path.dirname(company_db_path) or ".")
+        # نجهّز القاعدة الجديدة قبل حفظ مسارها، فلا تُنشر قاعدة تالفة لبقية الطلبات وإعادة التشغيل
+        try:
+            prepare_db(company_db_path or DEFAULT_DB)
+        except sqlite3.Error as e:
+            flash(f"Cannot use company DB: {e}", "danger")
+            return redirect(url_for("settings"))
+        if upload_folder:
             app.config["UPLOAD_FOLDER"] = upload_folder
-        with sqlite3.connect(DEFAULT_DB) as con:
-            con.execute(
-                """INSERT INTO settings (id, company_name, company_db_path, upload_folder)
-                   VALUES (1, ?, ?, ?)
-                   ON CONFLICT(id) DO UPDATE SET
-                     company_name=excluded.company_name,
-                     company_db_path=excluded.company_db_path,
-                     upload_folder=excluded.upload_folder
-                """,
-                (company_name, company_db_path, app.config["UPLOAD_FOLDER"]),
-            )
-        init_schema(get_db_path())
+        with _SETTINGS_LOCK:
+            with write_txn(get_con(DEFAULT_DB)) as con:
+                con.execute(
+                    _SQL["settings_upsert"],
+                    (company_name, company_db_path, app.config["UPLOAD_FOLDER"]),
+                )
+                row = con.execute(_SQL["settings_row"]).fetchone()
+            _set_settings(dict(row))
         flash("Settings saved.", "success")
         return redirect(url_for("settings"))
-    with sqlite3.connect(DEFAULT_DB) as con:
-        con.row_factory = sqlite3.Row
-        row = con.execute("SELECT * FROM settings WHERE id=1").fetchone()
-    return render_template("settings.html", settings=row)
+    return render_template("settings.html", settings=get_settings())
 
 AUTO_ASSIGN = {
     "شؤون الموظفين": {"أنواع": ["اجازة", "شهادة تعريف", "تحديث بيانات"], "مسؤول": "HR Team"},
@@ -333,67 +598,37 @@ def new_request():
         auto = AUTO_ASSIGN.get(data["category"], {})
         assignee = auto.get("مسؤول", "")
         status = "Submitted"
-        now = datetime.utcnow().isoformat()
+        now = utcnow_iso()
 
         db_path = get_db_path()
-        init_schema(db_path)
-        ensure_schema_compat(db_path)
+        ac = prepare_db(db_path)
 
-        with sqlite3.connect(db_path) as con:
+        con = get_con(db_path)
+        # BEGIN IMMEDIATE يحجز الكتابة قبل فحص الرقم، فلا يسبقنا عامل آخر بنفس الرقم ولا حاجة لإعادة المحاولة
+        with write_txn(con):
             request_no = generate_unique_request_no(con, raw_request_no)
+            cur = con.execute(
+                _SQL["insert_request"],
+                (
+                    request_no, data["employee_id"], data["employee_name"],
+                    data["cluster"], data["department"], data["category"], data["request_type"],
+                    data["details"], status, assignee, data["duration_days"], now, now,
+                ),
+            )
+            req_id = cur.lastrowid
+        _bump_requests_version()
 
-        try:
-            with sqlite3.connect(db_path) as con:
-                con.execute(
-                    """INSERT INTO requests
-                       (request_no, employee_id, employee_name, cluster, department,
-                        category, request_type, details, status, assignee, duration_days, created_at, updated_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (
-                        request_no, data["employee_id"], data["employee_name"],
-                        data["cluster"], data["department"], data["category"], data["request_type"],
-                        data["details"], status, assignee, data["duration_days"], now, now,
-                    ),
-                )
-                req_id = con.execute("SELECT last_insert_rowid()").fetchone()[0]
-        except IntegrityError:
-            with sqlite3.connect(db_path) as con:
-                request_no = generate_unique_request_no(con, request_no)
-                con.execute(
-                    """INSERT INTO requests
-                       (request_no, employee_id, employee_name, cluster, department,
-                        category, request_type, details, status, assignee, duration_days, created_at, updated_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (
-                        request_no, data["employee_id"], data["employee_name"],
-                        data["cluster"], data["department"], data["category"], data["request_type"],
-                        data["details"], status, assignee, data["duration_days"], now, now,
-                    ),
-                )
-                req_id = con.execute("SELECT last_insert_rowid()").fetchone()[0]
-
-        ac = discover_attachment_cols(db_path)
+        att_rows = []
         for f in request.files.getlist("attachments"):
             if f and allowed_file(f.filename):
-                filename = secure_filename(f.filename)
+                filename = _secure(f.filename)
                 savepath = os.path.join(app.config["UPLOAD_FOLDER"], f"{request_no}_{filename}")
-                f.save(savepath)
-                with sqlite3.connect(db_path) as con:
-                    if ac["has_path"] and ac["has_filepath"]:
-                        con.execute(
-                            "INSERT INTO attachments (request_id, filename, path, filepath, uploaded_at) VALUES (?, ?, ?, ?, ?)",
-                            (req_id, filename, savepath, savepath, now),
-                        )
-                    elif ac["has_filepath"]:
-                        con.execute(
-                            "INSERT INTO attachments (request_id, filename, filepath, uploaded_at) VALUES (?, ?, ?, ?)",
-                            (req_id, filename, savepath, now),
-                        )
-                    else:
-                        con.execute(
-                            "INSERT INTO attachments (request_id, filename, path, uploaded_at) VALUES (?, ?, ?, ?)",
-                            (req_id, filename, savepath, now),
-                        )
+                _store_upload(f, savepath)
+                att_rows.append((req_id, filename, *(savepath,) * ac["path_slots"], now))
+        if att_rows:
+            # معاملة واحدة لكل المرفقات: commit واحد بدل commit لكل ملف
+            with write_txn(con):
+                con.executemany(ac["insert_sql"], att_rows)
 
         if raw_request_no and raw_request_no != request_no:
             flash(f"رقم الطلب '{raw_request_no}' كان مستخدمًا؛ تم حفظ الطلب بالرقم: {request_no}", "warning")
@@ -406,29 +641,27 @@ def new_request():
 
 @app.route("/requests")
 def list_requests():
-    """تعرض كل الطلبات بترتيب الأحدث أولًا."""
+    """تعرض الطلبات صفحةً صفحة بترتيب الأحدث أولًا."""
+    page = max(request.args.get("page", 1, type=int), 1)
+    # OFFSET يجب أن يتسع في INTEGER الخاص بـ SQLite (64 بت) وإلا يرفع OverflowError
+    if page > _MAX_PAGE:
+        abort(404)
     db_path = get_db_path()
-    ensure_schema_compat(db_path)
-    with sqlite3.connect(db_path) as con:
-        con.row_factory = sqlite3.Row
-        rows = con.execute("SELECT * FROM requests ORDER BY datetime(created_at) DESC").fetchall()
+    # نجلب صفًا زائدًا لنعرف إن كانت هناك صفحة تالية بدون COUNT(*)
+    rows = get_con(db_path, readonly=True).execute(
+        _SQL["list_requests"], (REQUESTS_PER_PAGE + 1, (page - 1) * REQUESTS_PER_PAGE)
+    ).fetchall()
+    has_next = len(rows) > REQUESTS_PER_PAGE
     # 🔧 المهم: القالب يتوقع المتغيّر 'rows'
-    return render_template("list_requests.html", rows=rows)
+    return render_template("list_requests.html", rows=rows[:REQUESTS_PER_PAGE], page=page, has_next=has_next)
 
 @app.route("/requests/<request_no>")
 def view_request(request_no):
     db_path = get_db_path()
-    ensure_schema_compat(db_path)
-    ac = discover_attachment_cols(db_path)
-    with sqlite3.connect(db_path) as con:
-        con.row_factory = sqlite3.Row
-        req = con.execute("SELECT * FROM requests WHERE request_no=?", (request_no,)).fetchone()
-        att_rows = con.execute(
-            """SELECT * FROM attachments WHERE request_id = (
-                   SELECT id FROM requests WHERE request_no = ?
-               )""",
-            (request_no,),
-        ).fetchall()
+    ac = prepare_db(db_path)
+    con = get_con(db_path, readonly=True)
+    req = con.execute(_SQL["view_request_req"], (request_no,)).fetchone()
+    att_rows = con.execute(_SQL["view_request_atts"], (request_no,)).fetchall()
     if not req:
         flash("Request not found.", "danger")
         return redirect(url_for("list_requests"))
@@ -448,72 +681,134 @@ def view_request(request_no):
             "uploaded_at": r["uploaded_at"],
         })
 
-    created = datetime.fromisoformat((req["created_at"] or datetime.utcnow().isoformat()))
+    # الموعد المتوقع يحتاج اليوم فقط: نقرأ YYYY-MM-DD ونتجنب strftime (أبطأ بمرتين من isoformat)
+    created = date.fromisoformat(req["created_at"][:10]) if req["created_at"] else datetime.utcnow().date()
     eta = created + timedelta(days=req["duration_days"] or 0)
-    return render_template("view_request.html", req=req, attachments=attachments, eta=eta.strftime("%Y-%m-%d"))
+    return render_template("view_request.html", req=req, attachments=attachments, eta=eta.isoformat())
 
 @app.route("/requests/<request_no>/update", methods=["POST"])
 def update_status(request_no):
     new_status = request.form.get("status")
     assignee = request.form.get("assignee")
     db_path = get_db_path()
-    ensure_schema_compat(db_path)
-    with sqlite3.connect(db_path) as con:
+    with write_txn(get_con(db_path)) as con:
         con.execute(
-            "UPDATE requests SET status=?, assignee=?, updated_at=? WHERE request_no=?",
-            (new_status, assignee, datetime.utcnow().isoformat(), request_no),
+            _SQL["update_status"],
+            (new_status, assignee, utcnow_iso(), request_no),
         )
+    _bump_requests_version()
     flash("Request updated.", "success")
     return redirect(url_for("view_request", request_no=request_no))
 
 @app.route("/download/<path:filename>")
 def download_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename, as_attachment=True)
+    return _send_upload(filename, as_attachment=True)
 
 @app.route("/view/<path:filename>")
 def view_file(filename):
-    return send_from_directory(app.config["UPLOAD_FOLDER"], filename, as_attachment=False)
+    return _send_upload(filename, as_attachment=False)
+
+def _send_upload(filename: str, as_attachment: bool):
+    """يرسل المرفق؛ مع X_ACCEL_REDIRECT_PREFIX يرجع ترويسات فقط ويتولى nginx نقل الملف."""
+    if not X_ACCEL_REDIRECT_PREFIX:
+        return send_from_directory(app.config["UPLOAD_FOLDER"], filename, as_attachment=as_attachment)
+    # safe_join يرفض .. والمسارات المطلقة فلا يخرج الطلب من مجلد المرفقات
+    path = safe_join(os.path.join(app.root_path, app.config["UPLOAD_FOLDER"]), filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    # send_file بلا جسم يضبط Content-Type وContent-Disposition وETag، ثم نستبدل X-Sendfile بمسار nginx
+    resp = send_file(path, request.environ, as_attachment=as_attachment, use_x_sendfile=True,
+                     response_class=app.response_class, max_age=app.get_send_file_max_age)
+    resp.headers.pop("X-Sendfile", None)
+    resp.headers["X-Accel-Redirect"] = f"{X_ACCEL_REDIRECT_PREFIX}/{quote(filename)}"
+    return resp
 
 # ===================== Groq Chatbot (اختياري) =====================
+# رقم الطلب داخل رسالة المحادثة: "طلب 12" أو "request 12" أو "#12"
+_REQ_NO_RE = re.compile(r'(?:طلب|request|#)\s*(\d+)', re.IGNORECASE)
+
+_GROQ_PREFERRED = (
+    "llama-3.1-8b-instant","llama-3.1-70b-versatile",
+    "llama-3.2-90b-vision-preview","llama-3.2-11b-vision-preview",
+    "llama-guard-3-8b",
+)
+
 def _pick_groq_model(client, override: str = "") -> str:
-    preferred = [
-        "llama-3.1-8b-instant","llama-3.1-70b-versatile",
-        "llama-3.2-90b-vision-preview","llama-3.2-11b-vision-preview",
-        "llama-guard-3-8b",
-    ]
+    # أخطاء الشبكة تُرفع هنا ليقرر المتصل ألا يخزن النتيجة البديلة
     if override: return override
+    ids = {m.id for m in getattr(client.models.list(), "data", [])}
+    for m in _GROQ_PREFERRED:
+        if m in ids: return m
+    return _GROQ_PREFERRED[0]
+
+GROQ_MODEL_TTL = 3600  # ثوانٍ قبل إعادة سؤال Groq عن قائمة النماذج
+_GROQ_MODEL_CACHE = {}  # override -> (model_id, expires_at)
+_GROQ_MODEL_LOCK = threading.Lock()
+# مهلة قصيرة ومحاولة إعادة واحدة حتى لا يحجز Groq البطيء العامل لدقائق (الافتراضي 60s × 3 محاولات)
+GROQ_TIMEOUT = float(os.environ.get("GROQ_TIMEOUT", "20"))
+GROQ_MAX_RETRIES = int(os.environ.get("GROQ_MAX_RETRIES", "1"))
+# أقصى عدد نداءات Groq متزامنة في العملية: نترك بقية خيوط gthread لصفحات النظام
+# حتى لا تحجز محادثات بطيئة كل الخيوط فتتعطل لوحة التحكم والطلبات
+GROQ_MAX_CONCURRENCY = int(os.environ.get("GROQ_MAX_CONCURRENCY", "4"))
+_GROQ_SLOTS = threading.BoundedSemaphore(GROQ_MAX_CONCURRENCY)
+
+@functools.lru_cache(maxsize=1)
+def _get_groq_client():
+    """عميل واحد للعملية يعيد استخدام اتصال HTTPS بدل مصافحة TLS جديدة لكل رسالة."""
+    from groq import Groq
+    return Groq(api_key=os.environ.get("GROQ_API_KEY", ""),
+                timeout=GROQ_TIMEOUT, max_retries=GROQ_MAX_RETRIES)
+
+def _cached_groq_model(override: str) -> str:
+    """النموذج المختار لكل override مخزن لمدة GROQ_MODEL_TTL بدل نداء models.list() مع كل رسالة."""
+    hit = _GROQ_MODEL_CACHE.get(override)
+    if hit and hit[1] > time.monotonic():
+        return hit[0]
     try:
-        models = client.models.list()
-        ids = [m.id for m in getattr(models, "data", [])]
-        for m in preferred:
-            if m in ids: return m
+        model_id = _pick_groq_model(_get_groq_client(), override)
     except Exception:
-        pass
-    return preferred[0]
+        # لا نخزن البديل عند الفشل حتى تعيد الرسالة التالية المحاولة
+        return _GROQ_PREFERRED[0]
+    with _GROQ_MODEL_LOCK:
+        _GROQ_MODEL_CACHE[override] = (model_id, time.monotonic() + GROQ_MODEL_TTL)
+    return model_id
+
+def _sse_event(data: dict, event: str = "") -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_chat(stream, model_id: str):
+    try:
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                yield _sse_event({"delta": delta})
+        yield _sse_event({"model": model_id}, "done")
+    except Exception as e:
+        yield _sse_event({"error": f"{type(e).__name__}: {e}"}, "error")
 
 @app.route("/api/chat", methods=["POST"])
 def chat_api():
+    # لا ننتظر خانة فارغة طويلًا: رد 503 سريع أفضل من حجز خيط إضافي في الطابور
+    if not _GROQ_SLOTS.acquire(timeout=1):
+        return jsonify({"error": "المساعد مشغول حاليًا، حاول بعد لحظات"}), 503
+    release_now = True
     try:
-        from groq import Groq
-        client = Groq(api_key=os.environ.get("GROQ_API_KEY", ""))
+        client = _get_groq_client()
         payload = request.get_json(force=True) or {}
         user_message = (payload.get("message") or "").strip()
         override_model = (payload.get("model") or "").strip()
-        model_id = _pick_groq_model(client, override_model)
+        model_id = _cached_groq_model(override_model)
 
         db_path = get_db_path()
-        ensure_schema_compat(db_path)
         request_info = ""
 
-        import re
-        request_match = re.search(r'(?:طلب|request|#)\s*(\d+)', user_message, re.IGNORECASE)
+        request_match = _REQ_NO_RE.search(user_message)
         if request_match:
             request_no = request_match.group(1)
-            with sqlite3.connect(db_path) as con:
-                con.row_factory = sqlite3.Row
-                req = con.execute("SELECT * FROM requests WHERE request_no=?", (request_no,)).fetchone()
-                if req:
-                    request_info = f"""
+            req = get_con(db_path, readonly=True).execute(_SQL["chat_request"], (request_no,)).fetchone()
+            if req:
+                request_info = f"""
 
 معلومات الطلب #{request_no}:
 - رقم الموظف: {req['employee_id']}
@@ -526,14 +821,25 @@ def chat_api():
 - المدة المتوقعة: {req['duration_days']} أيام
 - تاريخ التقديم: {req['created_at'][:10]}
 - التفاصيل: {req['details']}
-                    """
+                """
 
         system_prompt = "أنت مساعد لمنصة طلبات داخلية. أجب باختصار وبالعربية الافتراضية إلا إذا طُلب غير ذلك."
         if request_info:
             user_message += f"\n\n{request_info}"
 
+        messages = [{"role":"system","content":system_prompt},{"role":"user","content":user_message}]
+        if payload.get("stream"):
+            # SSE: نرسل كل جزء فور وصوله من Groq بدل انتظار الرد كاملًا
+            stream = client.chat.completions.create(messages=messages, model=model_id, max_tokens=512, stream=True)
+            resp = Response(_sse_chat(stream, model_id), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+            # الخانة تبقى محجوزة حتى ينتهي البث فعليًا لا حتى يرجع المعالج
+            resp.call_on_close(_GROQ_SLOTS.release)
+            release_now = False
+            return resp
+
         resp = client.chat.completions.create(
-            messages=[{"role":"system","content":system_prompt},{"role":"user","content":user_message}],
+            messages=messages,
             model=model_id,
             max_tokens=512,
         )
@@ -542,6 +848,9 @@ def chat_api():
         return jsonify({"reply": text, "model": model_id})
     except Exception as e:
         return jsonify({"error": f"{type(e).__name__}: {e}"}), 500
+    finally:
+        if release_now:
+            _GROQ_SLOTS.release()
 
 # ===================== Main =====================
 if __name__ == "__main__":
@@ -0,0 +1,13 @@
+"""إعدادات Gunicorn للإنتاج: gunicorn -c gunicorn.conf.py app:app"""
+import multiprocessing
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# خيوط داخل كل عامل: الطلبات هنا تنتظر SQLite وGroq أكثر مما تستهلك المعالج
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+keepalive = 5
+timeout = 60
+# التهيئة وترحيل القاعدة عند الاستيراد تُنفَّذ مرة واحدة في العملية الأم قبل التفرّع
+preload_app = True
@@ -76,6 +76,7 @@ function addMessage(content, isUser = false) {
     
     // Scroll to bottom
     messagesContainer.scrollTop = messagesContainer.scrollHeight;
+    return contentDiv;
 }
 
 function addLoadingMessage() {
@@ -102,6 +103,17 @@ function removeLoadingMessage() {
     }
 }
 
+// Parse one Server-Sent Events block ("event: ...\ndata: ...")
+function parseSSE(block) {
+    let event = 'message';
+    let data = '';
+    block.split('\n').forEach(line => {
+        if (line.startsWith('event:')) event = line.slice(6).trim();
+        else if (line.startsWith('data:')) data += line.slice(5).trim();
+    });
+    return { event, data: data ? JSON.parse(data) : {} };
+}
+
 async function sendMessage() {
     const input = document.getElementById('chatInput');
     if (!input) return;
@@ -122,18 +134,54 @@ async function sendMessage() {
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ message: message }),
+            body: JSON.stringify({ message: message, stream: true }),
         });
         
-        const data = await response.json();
+        // Errors raised before streaming starts come back as JSON
+        if (!response.ok || !response.body) {
+            const data = await response.json();
+            removeLoadingMessage();
+            addMessage('عذراً، حدث خطأ: ' + (data.error || response.status), false);
+            return;
+        }
+        
+        // Render the reply token by token as it streams in
+        const messagesContainer = document.getElementById('chatMessages');
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let reply = '';
+        let bubble = null;
+        let errored = false;
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const evt = parseSSE(buffer.slice(0, sep));
+                buffer = buffer.slice(sep + 2);
+                if (evt.event === 'error') {
+                    errored = true;
+                    removeLoadingMessage();
+                    addMessage('عذراً، حدث خطأ: ' + evt.data.error, false);
+                } else if (evt.data.delta) {
+                    reply += evt.data.delta;
+                    if (!bubble) {
+                        removeLoadingMessage();
+                        bubble = addMessage('', false);
+                    }
+                    bubble.textContent = reply;
+                    messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                }
+            }
+        }
         
         // Remove loading indicator
         removeLoadingMessage();
-        
-        if (data.error) {
-            addMessage('عذراً، حدث خطأ: ' + data.error, false);
-        } else {
-            addMessage(data.reply || 'لم أستطع فهم السؤال', false);
+        // The error bubble already explains an empty reply
+        if (!bubble && !errored) {
+            addMessage('لم أستطع فهم السؤال', false);
         }
     } catch (error) {
         removeLoadingMessage();